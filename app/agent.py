@@ -1,5 +1,21 @@
-from app.schema import AgentInput, AgentOutput, SuggestedSolution
-from app.retriever import FeatureRetriever
+from dataclasses import dataclass
+from typing import List, Optional
+
+from app.schema import AgentInput
+from app.retriever import _get_retriever
+
+
+@dataclass(slots=True, frozen=True)
+class _Solution:
+    """Plain container mirroring `SuggestedSolution`; converted to pydantic only when serialized."""
+
+    feature_name: str
+    categories: List[str]
+    description: str
+    how_it_helps: str
+    relevance_score: float
+    link: Optional[str] = None
+
 
 class FilumAgent:
     """
@@ -15,32 +31,30 @@ class FilumAgent:
 
             Methods:
                 __init__():
-                    Initializes the FilumAgent instance and sets up the FeatureRetriever.
+                    Initializes the FilumAgent instance with the shared, cached FeatureRetriever.
+
+                run(user_input: AgentInput) -> List[_Solution]:
+                    Processes the user input, retrieves relevant features, and returns them as a list
+                    of lightweight `_Solution` dataclasses with the `SuggestedSolution` fields.
 
-                run(user_input: AgentInput) -> AgentOutput:
-                    Processes the user input, retrieves relevant features, and generates a list of
-                    suggested solutions encapsulated in an AgentOutput object.
+                run_batch(user_inputs: List[AgentInput]) -> List[List[_Solution]]:
+                    Processes many inputs with one batched retrieval and returns one list of
+                    solutions per input, in input order.
 
     Usage:
         Instantiate the `FilumAgent` class and call the `run` method with an `AgentInput` object to
-        retrieve suggested solutions based on the input.
+        retrieve suggested solutions based on the input. Wrap the result in `AgentOutput` (see
+        `main.py`) when it needs to be serialized.
     """
     def __init__(self):
-        self.retriever = FeatureRetriever()
+        self.retriever = _get_retriever()
 
-    def run(self, user_input: AgentInput) -> AgentOutput:
+    def run(self, user_input: AgentInput) -> List[_Solution]:
         raw_matches = self.retriever.retrieve(user_input)
+        return [_Solution(**feature) for feature in raw_matches]
 
-        solutions = []
-        for feature in raw_matches:
-            solution = SuggestedSolution(
-                feature_name=feature["feature_name"],
-                categories=feature.get("categories", []),
-                description=feature["description"],
-                how_it_helps=feature["how_it_helps"],
-                relevance_score=feature.get("relevance_score", 0.0),
-                link=feature.get("link")
-            )
-            solutions.append(solution)
-
-        return AgentOutput(suggested_solutions=solutions)
+    def run_batch(self, user_inputs: List[AgentInput]) -> List[List[_Solution]]:
+        return [
+            [_Solution(**feature) for feature in raw_matches]
+            for raw_matches in self.retriever.retrieve_batch(user_inputs)
+        ]
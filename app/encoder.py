@@ -0,0 +1,79 @@
+from typing import List
+from pathlib import Path
+
+import numpy as np
+
+
+class OnnxEncoder:
+    """
+    OnnxEncoder runs a sentence-transformers model through ONNX Runtime and reproduces
+    `SentenceTransformer.encode()` output (mean pooling + L2 normalization) as a numpy array.
+    It is an optional CPU backend for FeatureRetriever; `optimum[onnxruntime]` is only
+    imported when an OnnxEncoder is created.
+
+    Attributes:
+        device (str): Always "cpu"; mirrors `SentenceTransformer.device` for callers.
+        tokenizer: Hugging Face tokenizer matching the exported model.
+        session (onnxruntime.InferenceSession): Session running the exported transformer.
+
+    Methods:
+        __init__(model_name: str, model_dir: str):
+            Loads the exported model from `model_dir`, exporting `model_name` there first
+            if no `model.onnx` exists yet.
+
+        encode(sentences: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+            Returns normalized float32 sentence embeddings of shape (len(sentences), d). Inputs are
+            batched in token-length order to minimize padding; output rows follow input order.
+    """
+
+    device = "cpu"
+    max_seq_length = 256
+
+    def __init__(self, model_name: str, model_dir: str = "data/onnx"):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        path = Path(model_dir)
+        if (path / "model.onnx").exists():
+            ort_model = ORTModelForFeatureExtraction.from_pretrained(path)
+            self.tokenizer = AutoTokenizer.from_pretrained(path)
+        else:
+            ort_model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            ort_model.save_pretrained(path)
+            self.tokenizer.save_pretrained(path)
+
+        self.session = ort_model.model
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, sentences: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        # kwargs accepts SentenceTransformer.encode options (device, convert_to_numpy, ...)
+        # which are implied by this backend.
+        tokens = self.tokenizer(
+            sentences, truncation=True, max_length=self.max_seq_length
+        )
+
+        # Batch sentences of similar token length together so little padding is computed
+        order = np.argsort([len(ids) for ids in tokens["input_ids"]], kind="stable")
+
+        embeddings = []
+        for start in range(0, len(sentences), batch_size):
+            batch_idx = order[start : start + batch_size]
+            batch = self.tokenizer.pad(
+                {k: [v[i] for i in batch_idx] for k, v in tokens.items()},
+                return_tensors="np",
+            )
+            feed = {k: v for k, v in batch.items() if k in self._input_names}
+            hidden = self.session.run(None, feed)[0]
+
+            # Mean pooling over real tokens, then L2 norm, as in all-MiniLM-L6-v2
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+            embeddings.append(pooled / np.clip(norms, 1e-12, None))
+
+        # Undo the length sort so rows line up with the input sentences
+        sorted_embeddings = np.concatenate(embeddings).astype(np.float32, copy=False)
+        result = np.empty_like(sorted_embeddings)
+        result[order] = sorted_embeddings
+        return result
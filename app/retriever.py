@@ -1,13 +1,45 @@
+import functools
 import json
-from typing import List, Dict
+import logging
+import math
+import os
+from typing import ClassVar, List, Dict, Optional, Union
 from pathlib import Path
 
 from sentence_transformers import SentenceTransformer
+from numba import njit
 import faiss
 import numpy as np
+import torch
 
+from app.encoder import OnnxEncoder
 from app.schema import AgentInput
 
+logger = logging.getLogger(__name__)
+
+# Knowledge bases smaller than this are scanned in full with 8-bit scalar-quantized
+# vectors (4x less memory traffic than float32, negligible loss at 384-d);
+# IVF/PQ only pays off once there are enough vectors to train the coarse
+# quantizer and the PQ codebooks.
+IVF_MIN_FEATURES = 10_000
+IVF_NPROBE = 8
+PQ_M = 16
+# The 4-bit FastScan shortlist is re-scored with exact distances on
+# k_factor * top_k candidates, so the final ranking is not PQ-approximated.
+REFINE_K_FACTOR = 4
+# With a GPU, KBs this large are searched on device 0; they are also built as
+# IVF-SQ8, since FastScan and refine indexes have no GPU implementation.
+GPU_INDEX_MIN_FEATURES = 100_000
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+ENCODE_BATCH_SIZE = 64
+QUERY_BATCH_SIZE = 32
+# Industries, team sizes and channels are interned to bits of int64 mask words
+# (63 bits per word, keeping the sign bit clear)
+BITS_PER_MASK_WORD = 63
+# Set FILUM_USE_ONNX=1 to encode with ONNX Runtime instead of PyTorch (CPU hosts)
+ONNX_MODEL_DIR = "data/onnx"
+TORCH_INTEROP_THREADS = 2
+
 
 class FeatureRetriever:
     """
@@ -18,7 +50,8 @@ class FeatureRetriever:
     Attributes:
         kb_path (str): Path to the knowledge base JSON file containing feature descriptions.
         index_path (str): Path to store or load the FAISS index.
-        model (SentenceTransformer): Pre-trained sentence transformer model for embedding generation.
+        model (SentenceTransformer | OnnxEncoder): Sentence encoder for embedding generation; the
+            ONNX Runtime backend is used when the FILUM_USE_ONNX environment variable is "1".
         features (List[Dict]): List of features loaded from the knowledge base.
         index (faiss.Index): FAISS index for efficient similarity search.
 
@@ -26,98 +59,402 @@ class FeatureRetriever:
         __init__(kb_path: str, index_path: str):
             Initializes the FeatureRetriever with paths to the knowledge base and FAISS index.
 
+        _load_model(model_name: str, use_onnx: bool = False) -> SentenceTransformer | OnnxEncoder:
+            Loads an encoder once per model name and backend (PyTorch on CUDA when available,
+            or ONNX Runtime) and shares it across instances. The PyTorch backend first tunes
+            torch threading and matmul precision, and is optionally int8-quantized (CPU only)
+            and wrapped in torch.compile.
+
         _load_kb() -> List[Dict]:
             Loads the knowledge base from the specified JSON file.
 
+        _build_metadata_masks():
+            Interns each feature's industries, team sizes and channels into multi-word int64
+            bitmask arrays used by the reranking kernel.
+
         _build_or_load_index():
-            Builds a FAISS index from feature embeddings or loads an existing index from disk.
+            Builds an inner-product FAISS index from L2-normalized feature embeddings, or loads
+            an existing index from disk (rebuilding it if it no longer matches the KB).
+
+        _read_index(index_file: Path) -> faiss.Index:
+            Reads a persisted index memory-mapped: IVF inverted lists and, on Faiss builds with
+            IO_FLAG_MMAP_IFC, flat code stores (SQ8 codes, RFlat refine vectors).
+
+        _index_to_gpu(index: faiss.Index) -> faiss.Index:
+            Copies the index to GPU 0, keeping the CPU index if the index type is not supported.
 
-        retrieve(agent_input: AgentInput, top_k: int = 5) -> List[Dict]:
+        _create_index(d: int, n: int) -> faiss.Index:
+            Creates an 8-bit IndexScalarQuantizer for small knowledge bases and a 4-bit IVF-PQ FastScan
+            index with exact refinement once the knowledge base reaches IVF_MIN_FEATURES entries
+            (IVF-SQ8 instead when the index will be moved to a GPU).
+
+        retrieve(agent_input: AgentInput, top_k: int = 5, shortlist_k: int | None = None) -> List[Dict]:
             Retrieves the top-k relevant features based on semantic similarity to the agent's input.
+            When `shortlist_k` is larger than `top_k`, that many FAISS hits are reranked and the
+            best `top_k` are returned.
+
+        retrieve_batch(agent_inputs: List[AgentInput], top_k: int = 5, shortlist_k: int | None = None)
+                -> List[List[Dict]]:
+            Retrieves and reranks the top-k features for many inputs with a single batched encode
+            and FAISS search; returns one result list per input, in input order.
 
-        _rerank_with_context(agent_input: AgentInput, candidates: List[Dict], distances=None) -> List[Dict]:
+        _rerank_with_context(agent_input: AgentInput, indices: np.ndarray, distances=None,
+                top_k: int | None = None) -> List[Dict]:
             Reranks the retrieved features using contextual metadata from the agent's company profile.
+            `distances` holds the FAISS inner products, i.e. cosine similarities. Returns dicts
+            with exactly the `SuggestedSolution` fields.
     """
 
+    _models: ClassVar[Dict[str, Union[SentenceTransformer, OnnxEncoder]]] = {}
+
     def __init__(
         self, kb_path: str = "data/feature_kb.json", index_path: str = "data/index"
     ):
         self.kb_path = kb_path
         self.index_path = index_path
-        self.model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+        self.model = self._load_model(MODEL_NAME, os.environ.get("FILUM_USE_ONNX") == "1")
         self.features = self._load_kb()
+        self._build_metadata_masks()
+        # Kept on the instance so the GPU memory backing the index is not freed
+        self._gpu_resources = None
         self.index = self._build_or_load_index()
 
+    @classmethod
+    def _load_model(
+        cls, model_name: str, use_onnx: bool = False
+    ) -> Union[SentenceTransformer, OnnxEncoder]:
+        # Share weights between retrievers instead of reloading them per instance
+        key = f"{model_name}:onnx" if use_onnx else model_name
+        if key not in cls._models:
+            if use_onnx:
+                cls._models[key] = OnnxEncoder(model_name, ONNX_MODEL_DIR)
+            else:
+                _configure_torch()
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+                model = SentenceTransformer(model_name, device=device)
+                # Set FILUM_QUANTIZE=1 to run the Linear layers as int8 GEMMs on CPU. Quantizing
+                # takes tens of ms on the already loaded FP32 weights, so it is not cached.
+                if device == "cpu" and os.environ.get("FILUM_QUANTIZE") == "1":
+                    model[0].auto_model = torch.quantization.quantize_dynamic(
+                        model[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8
+                    )
+                # Set FILUM_TORCH_COMPILE=1 to run the encoder through torch.compile
+                if os.environ.get("FILUM_TORCH_COMPILE") == "1":
+                    model[0].auto_model = torch.compile(
+                        model[0].auto_model, mode="reduce-overhead"
+                    )
+                cls._models[key] = model
+        return cls._models[key]
+
     def _load_kb(self) -> List[Dict]:
         with open(self.kb_path, "r", encoding="utf-8") as f:
             return json.load(f)
 
+    def _build_metadata_masks(self):
+        # Intern each metadata value to one bit so the rerank checks become integer ANDs
+        self._industry_positions, self._industry_masks = _intern_masks(
+            [f.get("industries", []) for f in self.features]
+        )
+        self._team_positions, self._team_masks = _intern_masks(
+            [f.get("recommended_team_size", []) for f in self.features]
+        )
+        self._channel_positions, self._channel_masks = _intern_masks(
+            [f.get("channels_supported", []) for f in self.features]
+        )
+
     def _build_or_load_index(self):
         index_file = Path(self.index_path) / "faiss.index"
+        index = None
         if index_file.exists():
-            index = faiss.read_index(str(index_file))
-        else:
+            index = self._read_index(index_file)
+            # Rebuild indexes persisted for another metric or an older KB
+            if (
+                index.metric_type != faiss.METRIC_INNER_PRODUCT
+                or index.ntotal != len(self.features)
+            ):
+                index = None
+        if index is None:
             embeddings = self.model.encode(
                 [f["description"] + " " + f["how_it_helps"] for f in self.features],
+                batch_size=ENCODE_BATCH_SIZE,
+                show_progress_bar=False,
                 convert_to_numpy=True,
             )
-            index = faiss.IndexFlatL2(embeddings.shape[1])
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            faiss.normalize_L2(embeddings)
+            index = self._create_index(embeddings.shape[1], len(embeddings))
+            if not index.is_trained:
+                index.train(embeddings)
             index.add(embeddings)
             Path(self.index_path).mkdir(parents=True, exist_ok=True)
             faiss.write_index(index, str(index_file))
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = IVF_NPROBE
+        if isinstance(index, faiss.IndexRefine):
+            index.k_factor = REFINE_K_FACTOR
+        if _use_gpu_index(len(self.features)):
+            index = self._index_to_gpu(index)
         return index
 
-    def retrieve(self, agent_input: AgentInput, top_k: int = 5) -> List[Dict]:
+    def _index_to_gpu(self, index):
+        try:
+            resources = faiss.StandardGpuResources()
+            gpu_index = faiss.index_cpu_to_gpu(resources, 0, index)
+        except RuntimeError as e:
+            # e.g. a FastScan index persisted by a CPU-only host
+            logger.warning("Keeping FAISS index on CPU: %s", e)
+            return index
+        self._gpu_resources = resources
+        return gpu_index
+
+    @staticmethod
+    def _read_index(index_file: Path):
+        # IO_FLAG_MMAP maps classic IVF inverted lists; IO_FLAG_MMAP_IFC (Faiss >= 1.10)
+        # also maps flat code stores, i.e. the small-KB SQ8 codes and the RFlat refine
+        # vectors of the large-KB index. FastScan's block inverted lists are always read.
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        flags |= getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        return faiss.read_index(str(index_file), flags)
+
+    @staticmethod
+    def _create_index(d: int, n: int):
+        if n < IVF_MIN_FEATURES:
+            return faiss.IndexScalarQuantizer(
+                d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+        nlist = max(4, int(4 * math.sqrt(n)))
+        if _use_gpu_index(n):
+            return faiss.index_factory(d, f"IVF{nlist},SQ8", faiss.METRIC_INNER_PRODUCT)
+        return faiss.index_factory(
+            d, f"IVF{nlist},PQ{PQ_M}x4fs,RFlat", faiss.METRIC_INNER_PRODUCT
+        )
+
+    def retrieve(
+        self, agent_input: AgentInput, top_k: int = 5, shortlist_k: Optional[int] = None
+    ) -> List[Dict]:
         query = agent_input.pain_point
-        query_vector = self.model.encode([query])
-        distances, indices = self.index.search(np.array(query_vector), top_k)
+        query_vector = self.model.encode(
+            [query],
+            device=self.model.device,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        )
+        # FAISS wants float32 C-contiguous; a no-op when the encoder already returns that
+        query_vector = np.ascontiguousarray(query_vector, dtype=np.float32)
+        distances, indices = self.index.search(query_vector, max(top_k, shortlist_k or 0))
 
-        # get top-k features by semantic match
-        candidates = [self.features[i] for i in indices[0]]
+        # get top-k features by semantic match (IVF pads missing hits with -1)
+        hits = indices[0] >= 0
+        indices, distances = indices[:, hits], distances[:, hits]
 
-        # Print out distance of vector L2
-        print("\n[Semantic Search Results - Raw FAISS Distances]")
-        for i, (f, dist) in enumerate(zip(candidates, distances[0])):
-            print(f"[{i + 1}] {f['feature_name']} - L2 Distance: {dist:.4f}")
+        # Log cosine similarity of each match (formatting skipped unless DEBUG is on)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "faiss results: %s",
+                list(
+                    zip(
+                        (self.features[i]["feature_name"] for i in indices[0]),
+                        distances[0].tolist(),
+                    )
+                ),
+            )
 
         # hybrid logic: filter or rerank using metadata from company_profile
-        return self._rerank_with_context(agent_input, candidates, distances)
+        return self._rerank_with_context(agent_input, indices, distances, top_k)
+
+    def retrieve_batch(
+        self,
+        agent_inputs: List[AgentInput],
+        top_k: int = 5,
+        shortlist_k: Optional[int] = None,
+    ) -> List[List[Dict]]:
+        if not agent_inputs:
+            return []
+
+        # One encoder call and one FAISS search for the whole batch. Both encoder
+        # backends group queries by length before batching to minimize padding.
+        query_vectors = self.model.encode(
+            [agent_input.pain_point for agent_input in agent_inputs],
+            batch_size=QUERY_BATCH_SIZE,
+            device=self.model.device,
+            show_progress_bar=False,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        )
+        # FAISS wants float32 C-contiguous; a no-op when the encoder already returns that
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+        distances, indices = self.index.search(query_vectors, max(top_k, shortlist_k or 0))
+
+        results = []
+        for agent_input, row_distances, row_indices in zip(agent_inputs, distances, indices):
+            hits = row_indices >= 0
+            results.append(
+                self._rerank_with_context(
+                    agent_input,
+                    row_indices[hits][np.newaxis],
+                    row_distances[hits][np.newaxis],
+                    top_k,
+                )
+            )
+        return results
 
     def _rerank_with_context(
-        self, agent_input: AgentInput, candidates: List[Dict], distances=None
+        self,
+        agent_input: AgentInput,
+        indices: np.ndarray,
+        distances=None,
+        top_k: Optional[int] = None,
     ) -> List[Dict]:
         profile = agent_input.company_profile
+        candidates = indices[0]
+        if not len(candidates):
+            return []
+
+        # Inner products of normalized embeddings are cosine similarities
+        similarities = distances[0]
+        exp_scores = np.exp(similarities - similarities.max())
+        scores = exp_scores / exp_scores.sum()
 
-        # Convert FAISS L2 distance to cosine-like similarity (roughly)
-        similarities = [1 / (1 + d) for d in distances[0]]  # simple inverse
-        similarities = np.array(similarities)
-        softmax_scores = np.exp(similarities) / np.sum(np.exp(similarities))
+        # Apply hybrid weights (values missing from the KB vocabulary map to an
+        # empty mask, i.e. they never match)
+        if profile:
+            touchpoints = profile.customer_touchpoints or ()
+            scores = _context_scores(
+                scores,
+                candidates,
+                self._industry_masks,
+                self._team_masks,
+                self._channel_masks,
+                _mask_of(
+                    [profile.industry],
+                    self._industry_positions,
+                    self._industry_masks.shape[1],
+                ),
+                _mask_of(
+                    [profile.team_size], self._team_positions, self._team_masks.shape[1]
+                ),
+                _mask_of(
+                    touchpoints, self._channel_positions, self._channel_masks.shape[1]
+                ),
+                bool(profile.industry),
+                bool(profile.team_size),
+                bool(touchpoints),
+            )
+
+        # Select the top-k in O(n), then sort only those k
+        k = len(scores) if top_k is None else min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
 
+        # Shaped exactly like SuggestedSolution; fresh dicts (and a copied categories
+        # list) so neither scores nor caller mutations leak into the cached KB entries
         reranked = []
-        for i, f in enumerate(candidates):
-            score = softmax_scores[i]
-
-            # Apply hybrid weights
-            if profile:
-                # Industry match
-                if profile.industry and profile.industry not in f.get("industries", []):
-                    score *= 0.9
-
-                # Team size fit
-                if profile.team_size and profile.team_size not in f.get(
-                    "recommended_team_size", []
-                ):
-                    score *= 0.85
-
-                # Touchpoint overlap
-                if profile.customer_touchpoints:
-                    overlap = set(profile.customer_touchpoints).intersection(
-                        set(f.get("channels_supported", []))
-                    )
-                    if not overlap:
-                        score *= 0.85
+        for i in top:
+            f = self.features[candidates[i]]
+            reranked.append(
+                {
+                    "feature_name": f["feature_name"],
+                    "categories": list(f.get("categories", [])),
+                    "description": f["description"],
+                    "how_it_helps": f["how_it_helps"],
+                    "relevance_score": round(float(scores[i]), 4),
+                    "link": f.get("link"),
+                }
+            )
+        return reranked
+
+
+@functools.lru_cache(maxsize=1)
+def _get_retriever(
+    kb_path: str = "data/feature_kb.json", index_path: str = "data/index"
+) -> FeatureRetriever:
+    """Return a FeatureRetriever for the given paths, built once and reused."""
+    return FeatureRetriever(kb_path, index_path)
+
+
+def _intern_masks(values_per_feature: List[List[str]]):
+    """Map each distinct value to a bit position and return (positions, per-feature masks).
+
+    Masks are (n_features, n_words) int64 arrays, so any number of distinct values fits.
+    """
+    positions: Dict[str, int] = {}
+    for values in values_per_feature:
+        for value in values:
+            positions.setdefault(value, len(positions))
+
+    n_words = max(1, -(-len(positions) // BITS_PER_MASK_WORD))
+    masks = np.zeros((len(values_per_feature), n_words), dtype=np.int64)
+    for row, values in enumerate(values_per_feature):
+        masks[row] = _mask_of(values, positions, n_words)
+    return positions, masks
+
+
+def _mask_of(values, positions: Dict[str, int], n_words: int) -> np.ndarray:
+    # Values missing from `positions` set no bit, so they never match
+    mask = np.zeros(n_words, dtype=np.int64)
+    for value in values:
+        if value in positions:
+            word, bit = divmod(positions[value], BITS_PER_MASK_WORD)
+            mask[word] |= 1 << bit
+    return mask
+
+
+@njit(cache=True)
+def _overlaps(masks, row, query):
+    for word in range(query.shape[0]):
+        if masks[row, word] & query[word]:
+            return True
+    return False
+
+
+@njit(cache=True)
+def _context_scores(
+    scores,
+    candidates,
+    industry_masks,
+    team_masks,
+    channel_masks,
+    query_industry,
+    query_team,
+    query_touch,
+    check_industry,
+    check_team,
+    check_touch,
+):
+    out = np.empty_like(scores)
+    for i in range(scores.shape[0]):
+        row = candidates[i]
+        score = scores[i]
+        # Industry match
+        if check_industry and not _overlaps(industry_masks, row, query_industry):
+            score *= 0.9
+        # Team size fit
+        if check_team and not _overlaps(team_masks, row, query_team):
+            score *= 0.85
+        # Touchpoint overlap
+        if check_touch and not _overlaps(channel_masks, row, query_touch):
+            score *= 0.85
+        out[i] = score
+    return out
+
+
+def _use_gpu_index(n: int) -> bool:
+    return n >= GPU_INDEX_MIN_FEATURES and faiss.get_num_gpus() > 0
 
-            f["relevance_score"] = round(float(score), 4)
-            reranked.append(f)
 
-        return sorted(reranked, key=lambda x: x["relevance_score"], reverse=True)
+@functools.lru_cache(maxsize=None)
+def _configure_torch() -> None:
+    """Use every available core for intra-op work and allow faster float32 matmuls (runs once)."""
+    # Respect cgroup/affinity limits in containers; os.cpu_count() reports host cores
+    if hasattr(os, "sched_getaffinity"):
+        num_threads = len(os.sched_getaffinity(0))
+    else:
+        num_threads = os.cpu_count() or 4
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+    except RuntimeError:
+        # Only settable before the first inter-op parallel work in the process
+        pass
+    torch.set_float32_matmul_precision("high")
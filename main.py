@@ -1,27 +1,48 @@
 import argparse
-import json
-from app.agent import FilumAgent
-from app.schema import AgentInput
+import logging
+from dataclasses import asdict
+from typing import List
+
+import orjson
+
+from app.agent import FilumAgent, _Solution
+from app.schema import AgentInput, AgentOutput, SuggestedSolution
+
+
+def to_output(solutions: List[_Solution]) -> AgentOutput:
+    # Solutions come straight from the agent, so skip re-validating every field
+    return AgentOutput.model_construct(
+        suggested_solutions=[SuggestedSolution.model_construct(**asdict(s)) for s in solutions]
+    )
 
 
 def main():
     parser = argparse.ArgumentParser(description="Run Filum Pain Point to Solution Agent.")
     parser.add_argument("--input", type=str, required=True, help="Path to input JSON file")
     parser.add_argument("--output", type=str, default="output.json", help="Path to output JSON file")
+    parser.add_argument("--debug", action="store_true", help="Log raw FAISS search results")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.debug:
+        # Only our own loggers; numba, huggingface_hub etc. stay at WARNING
+        logging.getLogger("app").setLevel(logging.DEBUG)
 
     # Load input
-    with open(args.input, "r", encoding="utf-8") as f:
-        input_data = json.load(f)
-        agent_input = AgentInput(**input_data)
+    with open(args.input, "rb") as f:
+        input_data = orjson.loads(f.read())
 
-    # Run agent
+    # Run agent (a JSON list of inputs goes through the batched path)
     agent = FilumAgent()
-    output = agent.run(agent_input)
+    if isinstance(input_data, list):
+        batch = agent.run_batch([AgentInput(**item) for item in input_data])
+        result = [to_output(solutions).model_dump() for solutions in batch]
+    else:
+        solutions = agent.run(AgentInput(**input_data))
+        result = to_output(solutions).model_dump()
 
     # Save output
-    with open(args.output, "w", encoding="utf-8") as f:
-        f.write(output.model_dump_json(indent=2))
+    with open(args.output, "wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
 
     print(f"Suggestions written to {args.output}")
 